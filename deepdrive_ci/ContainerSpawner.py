@@ -1,6 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
 from tenacity import retry, retry_if_exception_type, stop_after_attempt
-import arrow, boto3, datetime, docker, logging, random, time
-from ue4helpers import DockerUtils
+import datetime, heapq, logging, random, threading, time
+
+# Note that arrow, boto3, docker and ue4helpers are imported only where they are needed, since they are slow to import
+
+# The socket timeout (in seconds) used when checking whether a Docker daemon is responsive
+PROBE_TIMEOUT = 5
+
+# The interval (in seconds) between attempts to connect to a Docker daemon that is still starting up
+DOCKER_POLL_INTERVAL = 2
+
+# The maximum number of worker threads used to probe the Docker daemons of our host pool concurrently
+MAX_PROBE_WORKERS = 32
+
+# The maximum number of pooled connections that our cached Docker clients keep open to each daemon
+DOCKER_POOL_SIZE = 50
+
+# The time (in seconds) for which we reuse the host pool details retrieved from EC2
+POOL_CACHE_TTL = 30
+
+# The minimum number of longest-running candidate hosts that we randomly select between when breaking ties
+# (When more hosts are tied, we select between the longest-running half of them instead)
+TIE_BREAK_CANDIDATES = 3
+
+# The interval (in seconds) and maximum number of attempts when polling for a started EC2 instance to be running
+# (These match the values used by the boto3 `instance_running` waiter)
+INSTANCE_POLL_INTERVAL = 15
+INSTANCE_POLL_ATTEMPTS = 40
+
+
+def _docker_errors():
+	'''
+	Returns the exception types that indicate a failure to communicate with a Docker daemon
+	'''
+	import docker, requests
+	return (docker.errors.DockerException, requests.exceptions.RequestException)
 
 
 class HostSelectionRestart(Exception):
@@ -16,7 +50,7 @@ class ContainerSpawner(object):
 	available pool of Amazon EC2 instances and starting a container on the selected host
 	'''
 	
-	def __init__(self, label, max_containers = 1, startup_time = 30):
+	def __init__(self, label, max_containers = 1, startup_time = 30, insecure_direct = False):
 		'''
 		Creates a new ContainerSpawner instance.
 		
@@ -29,12 +63,30 @@ class ContainerSpawner(object):
 		any given container host supports executing concurrently. (This can be overridden on a
 		per-host basis.)
 		
-		`startup_time` specifies the time (in seconds) that we wait for the Docker daemon to
-		finish starting up on freshly-booted container hosts.
+		`startup_time` specifies the maximum time (in seconds) that we wait for the Docker daemon
+		to finish starting up on freshly-booted container hosts.
+		
+		`insecure_direct` specifies whether we always connect to container hosts using unencrypted TCP
+		connections to port 2375 on their private IP addresses, ignoring any TLS configuration passed to
+		`spawn_container()`. This avoids the overhead of TLS handshakes, but exposes the Docker daemon without
+		authentication, so it must only be enabled when the security groups of the container hosts restrict
+		access to port 2375 to trusted clients within the same VPC.
 		'''
 		self._label = label
 		self._max_containers = max_containers
 		self._startup_time = startup_time
+		self._insecure_direct = insecure_direct
+		
+		# Cache our EC2 resource and Docker clients so they can be reused across retries
+		self._ec2 = None
+		self._docker_clients = {}
+		self._docker_clients_lock = threading.Lock()
+		
+		# Cache our host pool details, since pool membership rarely changes between retries
+		self._pool_cache = None
+		
+		# The Docker client for the daemon configured via environment variables, if any
+		self._env_client = None
 	
 	@retry(retry=retry_if_exception_type(HostSelectionRestart), stop=stop_after_attempt(5))
 	def spawn_container(self, image, tag = None, capacity = None, tls = None, options = {}):
@@ -53,7 +105,7 @@ class ContainerSpawner(object):
 		be used for any instances that do not have a value set for the tag if one was specified.)
 		
 		`tls` should be either an instance of `docker.tls.TLSConfig` or None for unencrypted
-		TCP connections.
+		TCP connections. (This is ignored if the spawner was created with `insecure_direct` set to True.)
 		
 		`options` should be a dictionary of keyword arguments to pass to the
 		`ue4helpers.DockerUtils.start_for_exec()` function.
@@ -61,29 +113,45 @@ class ContainerSpawner(object):
 		
 		# Retrieve the list of available EC2 instances and filter them to identify our host pool
 		logging.info('Retrieving container host pool details...')
-		ec2 = boto3.resource('ec2')
-		pool = ec2.instances.filter(Filters = None if tag is None else [
-			{
-				'Name': 'tag:{}'.format(tag[0]),
-				'Values': tag[1]
-			}
-		])
+		import boto3
+		self._ec2 = self._ec2 or boto3.resource('ec2')
+		pool = self._get_pool(tag)
+		self._prune_docker_clients(pool)
 		
-		# Retrieve the details for each of the instances in our pool
-		instances = list([self._get_instance_details(instance, capacity, tls) for instance in pool])
+		# Retrieve the details for each of the instances in our pool, probing the Docker daemons concurrently
+		# (The EC2 Instance resources are created here since boto3 resources are not thread-safe)
+		resources = [self._ec2.Instance(instance['InstanceId']) for instance in pool]
+		with ThreadPoolExecutor(max_workers=max(1, min(MAX_PROBE_WORKERS, len(pool)))) as executor:
+			instances = list(executor.map(
+				lambda instance, resource: self._get_instance_details(instance, resource, capacity, tls),
+				pool,
+				resources
+			))
 		logging.info('Retrieved details for {} hosts in our pool'.format(len(instances)))
 		
-		# Determine which instances are running and have available capacity and which instances are stopped
-		running = list([instance for instance in instances if self._has_capacity(instance)])
-		stopped = list([instance for instance in instances if instance['running'] == False])
+		# Determine which instances are stopped and which running instances with available capacity
+		# have the fewest running CI jobs, using a single pass over the pool
+		candidates = []
+		stopped = []
+		for instance in instances:
+			if self._has_capacity(instance):
+				if len(candidates) == 0 or instance['containers'] < candidates[0]['containers']:
+					candidates = [instance]
+				elif instance['containers'] == candidates[0]['containers']:
+					candidates.append(instance)
+			elif instance['running'] == False:
+				stopped.append(instance)
+		
 		selected = None
-		if len(running) > 0:
+		if len(candidates) > 0:
 			
 			# We have at least one running instance with available capacity, so we select the instance
-			# with the fewest running CI jobs, using random selection to break ties
-			minContainers = min([instance['containers'] for instance in running])
-			candidates = [instance for instance in running if instance['containers'] == minContainers]
-			selected = random.choice(candidates)
+			# with the fewest running CI jobs, breaking ties randomly between the longest-running instances
+			# (This favours established hosts so recently-started hosts can go idle, whilst still spreading
+			#  concurrent spawners that see the same pool across multiple hosts)
+			count = max(TIE_BREAK_CANDIDATES, len(candidates) // 2)
+			oldest = heapq.nsmallest(count, candidates, key=lambda instance: instance['launched'])
+			selected = random.choice(oldest)
 			
 		elif len(stopped) > 0:
 			
@@ -93,14 +161,16 @@ class ContainerSpawner(object):
 			# Attempt to start the instance
 			logging.info('Starting stopped instance {}...'.format(selected['instance'].id))
 			selected['instance'].start()
-			selected['instance'].wait_until_running()
-			
-			# Wait until the Docker daemon has had a chance to start
-			time.sleep(self._startup_time)
+			self._pool_cache = None
+			description = self._wait_until_running(selected['instance'].id)
+			if description is None:
+				logging.info('Instance failed to start, restarting selection process...')
+				raise HostSelectionRestart
 			
-			# Attempt to connect to the Docker daemon and query the container count
+			# Attempt to connect to the Docker daemon and query the container count, waiting for the daemon to start
 			# (If this fails then either the daemon crashed or the instance has been shutdown)
-			selected = self._get_instance_details(selected['instance'], capacity, tls)
+			deadline = time.monotonic() + self._startup_time
+			selected = self._get_instance_details(description, selected['instance'], capacity, tls, deadline)
 			if selected['docker'] == None:
 				logging.info('Failed to connect to the Docker daemon, restarting selection process...')
 				raise HostSelectionRestart
@@ -114,38 +184,139 @@ class ContainerSpawner(object):
 			raise HostSelectionRestart
 		
 		# Attempt to start a container on the selected host
+		from ue4helpers import DockerUtils
 		container = None
 		try:
 			logging.info('Starting container on instance {}...'.format(selected['instance'].id))
 			container = DockerUtils.start_for_exec(selected['docker'], image, labels=[self._label], **options)
-		except:
-			logging.info('Failed to start container, restarting selection process...')
+		except _docker_errors() as err:
+			logging.info('Failed to start container ({}), restarting selection process...'.format(err))
 			raise HostSelectionRestart
 		
 		# Verify that we have not inadvertently exceeded the maximum occupancy of the host due to a timing error
-		containers = self._running_containers(selected)
-		if len(containers) > selected['capacity']:
-			
-			# Occupancy has been exceeded, so use container creation times to determine if our container is to blame
-			created = sorted([arrow.get(c.attrs['Created']) for c in containers])
-			surplus = created[ (len(containers) - self._max_containers)-1 : ]
-			if arrow.get(container.attrs['Created']) in surplus:
-				logging.info('Timing error detected, stopping surplus container...')
-				container.stop()
-				raise HostSelectionRestart
+		# (If we cannot verify the occupancy then we stop our container rather than risk leaving the host overfilled)
+		try:
+			containers = self._running_containers(selected)
+			surplus = []
+			if len(containers) > selected['capacity']:
+				
+				# Occupancy has been exceeded, so use container creation times to determine if our container is to blame
+				# (The surplus containers are the most recently created ones beyond the capacity of the host. Note that we
+				#  inspect each container to retrieve its precise creation time, since the container list only provides
+				#  whole-second timestamps and racing containers are typically created within the same second.)
+				created = self._creation_times(selected, containers)
+				surplus = heapq.nlargest(len(created) - selected['capacity'], created)
+		except _docker_errors() as err:
+			logging.info('Failed to verify host occupancy ({}), stopping container and restarting selection process...'.format(err))
+			container.stop()
+			raise HostSelectionRestart
+		
+		if container.id in [c[1] for c in surplus]:
+			logging.info('Timing error detected, stopping surplus container...')
+			container.stop()
+			raise HostSelectionRestart
 		
 		return container
 	
+	def spawn_container_from_env(self, image, options = {}):
+		'''
+		Starts a container on the Docker daemon configured via the standard Docker environment variables
+		(`DOCKER_HOST`, `DOCKER_TLS_VERIFY` and `DOCKER_CERT_PATH`), bypassing EC2 host selection entirely.
+		Note that the occupancy of the daemon is not checked, so any capacity limits are not enforced.
+		
+		`image` is the name of the Docker image that the container will be based on.
+		
+		`options` should be a dictionary of keyword arguments to pass to the
+		`ue4helpers.DockerUtils.start_for_exec()` function.
+		'''
+		import docker
+		from ue4helpers import DockerUtils
+		self._env_client = self._env_client or docker.from_env()
+		logging.warning('Starting container on the Docker daemon at {} from the environment, bypassing host selection...'.format(
+			self._env_client.api.base_url
+		))
+		return DockerUtils.start_for_exec(self._env_client, image, labels=[self._label], **options)
+	
 	
 	# "Private" methods
 	
+	def _get_pool(self, tag = None):
+		'''
+		Retrieves the descriptions for the EC2 instances in our host pool, reusing the cached descriptions
+		if they were retrieved for the same `tag` filter within the last `POOL_CACHE_TTL` seconds
+		'''
+		key = None if tag is None else (tag[0], tuple(tag[1]))
+		if self._pool_cache is not None:
+			timestamp, cachedKey, pool = self._pool_cache
+			if cachedKey == key and time.monotonic() - timestamp < POOL_CACHE_TTL:
+				return pool
+		
+		filters = {} if tag is None else {'Filters': [
+			{
+				'Name': 'tag:{}'.format(tag[0]),
+				'Values': tag[1]
+			}
+		]}
+		pool = self._describe_instances(**filters)
+		self._pool_cache = (time.monotonic(), key, pool)
+		return pool
+	
+	def _describe_instances(self, **kwargs):
+		'''
+		Retrieves the descriptions for all EC2 instances matching the supplied DescribeInstances parameters,
+		using a single batched query rather than lazily loading the attributes of each instance individually
+		'''
+		paginator = self._ec2.meta.client.get_paginator('describe_instances')
+		return [
+			instance
+			for page in paginator.paginate(**kwargs)
+			for reservation in page['Reservations']
+			for instance in reservation['Instances']
+		]
+	
+	def _wait_until_running(self, instanceId):
+		'''
+		Waits for the specified EC2 instance to enter the running state and returns its description, or None
+		if the instance did not start. The description from the final poll is returned directly, so no
+		further DescribeInstances query is needed to retrieve the details of the started instance.
+		'''
+		for _ in range(INSTANCE_POLL_ATTEMPTS):
+			description = self._describe_instances(InstanceIds=[instanceId])[0]
+			state = description['State']['Name']
+			if state == 'running':
+				return description
+			elif state in ['shutting-down', 'terminated', 'stopping']:
+				return None
+			time.sleep(INSTANCE_POLL_INTERVAL)
+		
+		return None
+	
 	def _running_containers(self, instance):
 		'''
 		Queries the Docker daemon on the specified container host to retrieve the list of running containers.
 		Containers are only included if they have the label that we use to spawn new containers, which ensures
 		arbitrary containers (e.g. system support services) are ignored.
+		
+		Containers are returned as the raw dictionaries from the Docker API rather than as model objects,
+		since we only need their count and IDs.
 		'''
-		return instance['docker'].containers.list(filters={'label': self._label})
+		return instance['api'].containers(filters={'label': self._label})
+	
+	def _creation_times(self, instance, containers):
+		'''
+		Inspects the specified containers on the specified container host and returns a list of tuples containing
+		the precise creation time and ID of each container. Containers that no longer exist are omitted.
+		'''
+		import arrow, docker
+		created = []
+		for container in containers:
+			try:
+				details = instance['api'].inspect_container(container['Id'])
+				created.append((arrow.get(details['Created']), container['Id']))
+			except docker.errors.NotFound:
+				pass
+		
+		return created
 	
 	def _has_capacity(self, instance):
 		'''
@@ -153,11 +324,97 @@ class ContainerSpawner(object):
 		'''
 		return instance['running'] == True and instance['docker'] is not None and instance['containers'] < instance['capacity']
 	
-	def _get_instance_details(self, instance, capacity = None, tls = None):
+	def _docker_client(self, ip, port, tls = None):
+		'''
+		Retrieves a tuple containing a low-level `docker.APIClient` and a `docker.DockerClient` for the daemon
+		at the specified address, reusing any cached clients with the same TLS configuration that are still
+		responsive. Raises an exception if the daemon cannot be reached.
+		
+		At most one pair of clients is cached for each address. If the cached clients were created with a
+		different `docker.tls.TLSConfig` object then they are closed and replaced.
+		
+		The low-level client has a short socket timeout and is used for read-only probing, so that an
+		unreachable daemon cannot stall host selection. The high-level client retains the default timeout,
+		since it is also used for long-running operations once a container has been started.
+		'''
+		key = (ip, port)
+		with self._docker_clients_lock:
+			cached = self._docker_clients.get(key)
+		if cached is not None:
+			cachedTls, clients = cached
+			if cachedTls is tls:
+				try:
+					clients[0].ping()
+					return clients
+				except _docker_errors():
+					pass
+			
+			# The cached clients are stale or use a different TLS configuration, so discard them and create new ones
+			with self._docker_clients_lock:
+				if self._docker_clients.get(key) is cached:
+					self._docker_clients.pop(key)
+			self._close_docker_clients(clients)
+		
+		import docker
+		baseUrl = 'tcp://{}:{}'.format(ip, port)
+		api = docker.APIClient(base_url=baseUrl, tls=tls, timeout=PROBE_TIMEOUT, max_pool_size=DOCKER_POOL_SIZE)
+		api.ping()
+		clients = (api, docker.DockerClient(base_url=baseUrl, tls=tls, max_pool_size=DOCKER_POOL_SIZE))
+		with self._docker_clients_lock:
+			previous = self._docker_clients.get(key)
+			self._docker_clients[key] = (tls, clients)
+		if previous is not None:
+			self._close_docker_clients(previous[1])
+		return clients
+	
+	def _prune_docker_clients(self, pool):
+		'''
+		Discards and closes any cached Docker clients for addresses that do not belong to the instances in
+		the specified host pool, so that clients for departed hosts are not kept open indefinitely
+		'''
+		addresses = set()
+		for instance in pool:
+			addresses.update([instance.get('PublicIpAddress'), instance.get('PrivateIpAddress')])
+		
+		with self._docker_clients_lock:
+			departed = [key for key in self._docker_clients if key[0] not in addresses]
+			removed = [self._docker_clients.pop(key) for key in departed]
+		for tls, clients in removed:
+			self._close_docker_clients(clients)
+	
+	def _close_docker_clients(self, clients):
+		'''
+		Closes a tuple of clients as returned by `_docker_client()`, ignoring any errors
+		'''
+		for client in clients:
+			try:
+				client.close()
+			except _docker_errors():
+				pass
+	
+	def _wait_for_docker(self, ip, port, tls, deadline):
+		'''
+		Repeatedly attempts to connect to the Docker daemon at the specified address until it responds or
+		the specified deadline (a `time.monotonic()` value) elapses, in which case the last error is raised.
+		Returns the same tuple of clients as `_docker_client()`.
+		'''
+		while True:
+			try:
+				return self._docker_client(ip, port, tls)
+			except _docker_errors():
+				if time.monotonic() >= deadline:
+					raise
+				time.sleep(DOCKER_POLL_INTERVAL)
+	
+	def _get_instance_details(self, instance, resource, capacity = None, tls = None, deadline = None):
 		'''
 		Retrieves the details for an EC2 instance, including the number of running Docker containers.
 		
-		`instance` should be an instance of `boto3.EC2.Instance`.
+		`instance` should be an instance description dictionary as returned by the EC2 DescribeInstances API.
+		
+		`resource` should be the `boto3.EC2.Instance` for the instance, which is only used for actions and
+		therefore never needs to load its attributes. (This is created by the caller, since this method may
+		be called from worker threads and boto3 resources are not thread-safe.)
 		
 		`capacity` should be either a string containing the EC2 tag name that is used to determine the
 		maximum number of containers that an instance supports executing concurrently, or None if we
@@ -166,45 +423,55 @@ class ContainerSpawner(object):
 		
 		`tls` should be either an instance of `docker.tls.TLSConfig` or None for unencrypted
 		TCP connections.
-		'''
 		
-		# Determine if we have an instance-specific capacity override
-		detectedCapacity = self._max_containers
-		capacityTags = [tag for tag in instance.tags if tag['Key'] == capacity]
-		if capacity is not None and len(capacityTags) > 0:
-			detectedCapacity = int(capacityTags[0]['Value'])
+		`deadline` can be used to specify a `time.monotonic()` value until which we keep waiting for the
+		Docker daemon to start. If None then we only wait if the instance has only just booted up.
+		'''
 		
 		# Create our details object
 		details = {
-			'instance': instance,
-			'capacity': detectedCapacity,
-			'running': instance.state['Name'] == 'running',
+			'instance': resource,
+			'capacity': self._max_containers,
+			'running': instance['State']['Name'] == 'running',
+			'launched': instance['LaunchTime'],
+			'api': None,
 			'docker': None,
 			'containers': 0
 		}
 		
-		# If the instance is running, attempt to retrieve the container count from the Docker daemon
-		if details['running'] == True:
-			try:
-				
-				# If the instance has only just booted up then wait until the Docker daemon has had a chance to start
-				uptime = (datetime.datetime.now(datetime.timezone.utc) - instance.launch_time).total_seconds()
-				if uptime < self._startup_time:
-					time.sleep(self._startup_time - uptime)
-				
-				# Attempt to connect to the Docker daemon
-				ip = instance.public_ip_address if tls is not None else instance.private_ip_address
-				port = 2376 if tls is not None else 2375
-				client = docker.DockerClient(base_url='tcp://{}:{}'.format(ip, port), tls=tls)
-				client.ping()
-				
-				# If the connection was successful, store the container count and Docker client
-				details['docker'] = client
-				details['containers'] = len(self._running_containers(details))
-				
-			except:
-				
-				# Could not connect to the Docker daemon
-				pass
+		# If the instance is not running then there is nothing further to retrieve
+		# (The capacity of a stopped instance is only needed once it has been started and its details retrieved again)
+		if details['running'] == False:
+			return details
+		
+		# Determine if we have an instance-specific capacity override
+		capacityTags = [tag for tag in instance.get('Tags', []) if tag['Key'] == capacity]
+		if capacity is not None and len(capacityTags) > 0:
+			details['capacity'] = int(capacityTags[0]['Value'])
+		
+		# If direct connections have been requested then bypass TLS regardless of our configuration
+		if self._insecure_direct == True:
+			tls = None
+		
+		# Attempt to retrieve the container count from the Docker daemon
+		try:
+			
+			# If the instance has only just booted up then allow the Docker daemon time to start
+			if deadline is None:
+				uptime = (datetime.datetime.now(datetime.timezone.utc) - instance['LaunchTime']).total_seconds()
+				deadline = time.monotonic() + max(0, self._startup_time - uptime)
+			
+			# Attempt to connect to the Docker daemon
+			ip = instance.get('PublicIpAddress') if tls is not None else instance.get('PrivateIpAddress')
+			port = 2376 if tls is not None else 2375
+			details['api'], details['docker'] = self._wait_for_docker(ip, port, tls, deadline)
+			
+			# If the connection was successful, store the container count
+			details['containers'] = len(self._running_containers(details))
+			
+		except _docker_errors():
+			
+			# Could not connect to the Docker daemon
+			pass
 		
 		return details
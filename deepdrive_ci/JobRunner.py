@@ -1,17 +1,24 @@
 from .ContainerSpawner import ContainerSpawner
 from .PlatformDefaults import PlatformDefaults
-from ue4helpers import AWSUtils, DockerUtils
-import docker, logging, os, tempfile
+import logging, os, threading
 from termcolor import colored
 
+# The format string for our log output, which never changes
+_LOG_FORMAT = colored('[' + os.path.basename(__file__) + ' {name}]: {message}', color='yellow', attrs=['bold'])
+
 
 class JobRunner(object):
 	'''
 	Provides functionality for running CI jobs
 	'''
 	
+	# The container spawner shared by all jobs run on each thread, so that its cached EC2 resource,
+	# Docker clients and host pool details are reused across jobs (Each thread has its own spawner,
+	# since boto3 resources are not thread-safe and so cannot be shared by concurrent jobs.)
+	_local = threading.local()
+	
 	@staticmethod
-	def run_job(job_logic, platform, image = None, container_options = {}):
+	def run_job(job_logic, platform, image = None, container_options = {}, use_docker_env = False):
 		'''
 		Starts a Docker container on an appropriate EC2 host and runs the supplied CI job logic.
 		
@@ -25,11 +32,16 @@ class JobRunner(object):
 		
 		`container_options` can be used to specify a dictionary of keyword arguments to pass to the
 		`ue4helpers.DockerUtils.start_for_exec()` function.
+		
+		`use_docker_env` can be set to True to start the container on the Docker daemon specified by the standard
+		Docker environment variables (`DOCKER_HOST`, `DOCKER_TLS_VERIFY` and `DOCKER_CERT_PATH`) instead of an EC2
+		host. In this case no host selection is performed, so `platform` is only used to determine the default
+		container image, and no occupancy limits are enforced for the daemon.
 		'''
 		
 		# Write log output to stderr
 		logging.basicConfig(
-			format = colored('[' + os.path.basename(__file__) + ' {name}]: {message}', color='yellow', attrs=['bold']),
+			format = _LOG_FORMAT,
 			level = logging.INFO,
 			style = '{'
 		)
@@ -41,8 +53,14 @@ class JobRunner(object):
 		# Start a Docker container within which the CI job will be run
 		# (For jobs that actually build and run their own custom container images, this container will
 		#  just act as a proxy for our build when the CI system queries the container host's occupancy)
-		spawner = ContainerSpawner('io.deepdrive.ci')
-		container = spawner.spawn_container(image, ('ci-platform', [platform]), 'ci-capacity', None, container_options)
+		spawner = getattr(JobRunner._local, 'spawner', None)
+		if spawner is None:
+			spawner = JobRunner._local.spawner = ContainerSpawner('io.deepdrive.ci')
+		if use_docker_env == True:
+			container = spawner.spawn_container_from_env(image, container_options)
+		else:
+			container = spawner.spawn_container(image, ('ci-platform', [platform]), 'ci-capacity', None, container_options)
+		from ue4helpers import DockerUtils
 		with DockerUtils.automatically_stop(container):
 			
 			# Run the actual logic for the CI job
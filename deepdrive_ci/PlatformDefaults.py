@@ -1,5 +1,13 @@
 from .TargetPlatform import TargetPlatform
 
+# The default container image for each of our supported container platforms
+_DEFAULT_IMAGES = {
+	
+	TargetPlatform.Linux: 'adamrehn/ue4-full:4.21.2-cudagl10.0',
+	TargetPlatform.Windows: 'adamrehn/ue4-full:4.21.2-ltsc2019'
+	
+}
+
 class PlatformDefaults(object):
 	'''
 	The default configuration values for each of our supported container platforms
@@ -10,9 +18,4 @@ class PlatformDefaults(object):
 		'''
 		Returns the default container image for the specified platform
 		'''
-		return {
-			
-			TargetPlatform.Linux: 'adamrehn/ue4-full:4.21.2-cudagl10.0',
-			TargetPlatform.Windows: 'adamrehn/ue4-full:4.21.2-ltsc2019'
-			
-		}[platform]
+		return _DEFAULT_IMAGES[platform]
@@ -30,7 +30,8 @@ setup(
 	install_requires = [
 		'arrow',
 		'boto3',
-		'docker>=3.7.0',
+		'docker>=4.3.0',
+		'requests',
 		'setuptools>=38.6.0',
 		'tenacity',
 		'termcolor',